@@ -1,7 +1,14 @@
 import streamlit as st
 import pandas as pd
 import gspread
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 from datetime import datetime
+from functools import lru_cache
+import os
+import tempfile
+import threading
+import time
 import uuid # To generate unique referral IDs
 
 st.set_page_config(layout="wide", page_title="Hospital Referral System 🏥")
@@ -10,6 +17,18 @@ st.set_page_config(layout="wide", page_title="Hospital Referral System 🏥")
 # For Streamlit Cloud deployment, you'd store this content in st.secrets
 GOOGLE_SHEET_NAME = "KosofeReferral" # Your Google Sheet name
 WORKSHEET_NAME = "Sheet1" # The specific worksheet name within your sheet
+SHEET_COLUMN_COUNT = 14 # Columns A:N, 'Referral ID' through 'Locked By' (same order as row_data below)
+LAST_COLUMN = gspread.utils.rowcol_to_a1(1, SHEET_COLUMN_COUNT).rstrip("1") # Column letter of the last app column
+LOCK_COLUMN = "Locked By" # Optional header in column N; acknowledgement locking is skipped if it's missing
+LOCK_TIMEOUT_SECONDS = 300 # A lock older than this is treated as abandoned
+LOAD_ATTEMPTS = 3 # Reloads allowed when our own writes keep landing while the data is being fetched
+WRITE_POLL_INTERVAL = "2s" # How often the page checks on background saves while any are still running
+# Local copy of the sheet (patient data), reused until the sheet changes. Kept outside the app directory,
+# readable only by the user running the app; see the README.
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "gbagada-referrals")
+CACHE_PATH = os.path.join(CACHE_DIR, "referrals_cache.parquet")
+CACHE_VERSION_PATH = CACHE_PATH + ".version" # "<format>:<Drive modifiedTime>" the local copy was taken at
+CACHE_FORMAT = "2" # Bump whenever the shape of load_data's DataFrame changes, so older copies are ignored
 
 # --- Google Sheets Connection (Cached to avoid reconnecting on every rerun) ---
 @st.cache_resource
@@ -20,6 +39,11 @@ def get_google_sheet_client():
             gc = gspread.service_account_from_dict(st.secrets["gcp_service_account"])
         else: # Fallback to local file for development
             gc = gspread.service_account(filename="credentials.json")
+        # The authorized session already keeps connections alive, but its default pool holds 10 per host.
+        # Widen it so the write executor's workers plus concurrent script threads can all reuse a connection
+        # instead of having extras discarded ("Connection pool is full").
+        http_client = getattr(gc, "http_client", gc) # gspread >= 6 holds the session on gc.http_client
+        http_client.session.mount("https://", HTTPAdapter(pool_maxsize=32))
         return gc
     except Exception as e:
         st.error(f"Error connecting to Google Sheets: {e}")
@@ -28,13 +52,115 @@ def get_google_sheet_client():
 
 gc = get_google_sheet_client()
 
-@st.cache_data(ttl=60) # Cache data for 60 seconds
+# --- Worksheet Handle (Cached so the spreadsheet isn't re-opened on every call) ---
+@st.cache_resource
+def get_worksheet():
+    spreadsheet = gc.open(GOOGLE_SHEET_NAME)
+    return spreadsheet.worksheet(WORKSHEET_NAME)
+
+def get_sheet_modified_time():
+    # One tiny Drive API call that tells us whether the sheet changed since the local copy was saved
+    spreadsheet_id = get_worksheet().spreadsheet.id
+    http_client = getattr(gc, "http_client", gc) # gspread >= 6 exposes request() on gc.http_client
+    response = http_client.request(
+        "get",
+        f"{gspread.urls.DRIVE_FILES_API_V3_URL}/{spreadsheet_id}",
+        params={"fields": "modifiedTime", "supportsAllDrives": True},
+    )
+    return response.json()["modifiedTime"]
+
+# Shared by every session: a lock around the on-disk copy, and a generation that each invalidation bumps
+@st.cache_resource
+def get_data_cache_state():
+    return {"lock": threading.Lock(), "generation": 0}
+
+def read_cached_data(modified_time):
+    state = get_data_cache_state()
+    try:
+        with state["lock"]:
+            with open(CACHE_VERSION_PATH) as f:
+                if f.read() != f"{CACHE_FORMAT}:{modified_time}":
+                    return None
+            return pd.read_parquet(CACHE_PATH)
+    except (OSError, ValueError, ImportError):
+        return None # No usable local copy yet
+
+def write_private_file(path, write):
+    # Write to a 0600 temp file in the same directory, then swap it in so readers never see a partial file
+    fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR)
+    os.close(fd)
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+def write_cached_data(df, modified_time, generation):
+    state = get_data_cache_state()
+    try:
+        with state["lock"]:
+            if state["generation"] != generation:
+                return # A write landed while this copy was being fetched; it may predate that write
+            os.makedirs(CACHE_DIR, mode=0o700, exist_ok=True)
+            write_private_file(CACHE_PATH, df.to_parquet)
+            def write_version(path):
+                with open(path, "w") as f:
+                    f.write(f"{CACHE_FORMAT}:{modified_time}")
+            write_private_file(CACHE_VERSION_PATH, write_version)
+    except (OSError, ValueError, ImportError):
+        pass # The local copy is only an optimisation
+
+def invalidate_data_cache():
+    # Drop the in-memory copy and the on-disk one, in case Drive's modifiedTime lags behind our write.
+    # Bumping the generation stops a load that started before this write from saving its older copy.
+    state = get_data_cache_state()
+    with state["lock"]:
+        state["generation"] += 1
+        try:
+            os.remove(CACHE_VERSION_PATH)
+        except OSError:
+            pass
+    load_data.clear()
+
+# Cache data for 60 seconds. Only called from the Gbagada view (and the update and lock helpers it drives);
+# releasing a lock from the PHC view uses the remembered row instead, so PHC sessions never pay for the
+# sheet fetch. Keep it that way and don't warm it at startup.
+def fetch_data(generation):
+    # One load, from the local copy if the sheet hasn't changed since it was saved, otherwise from the sheet
+    try:
+        version = get_sheet_modified_time()
+    except Exception:
+        version = None # Fall back to a full fetch if Drive can't be asked
+    if version is not None:
+        df = read_cached_data(version)
+        if df is not None:
+            return df
+
+    # Only fetch the app's own columns, so anything added to the right of the sheet isn't downloaded
+    values = get_worksheet().get(f"A:{LAST_COLUMN}") # Header row followed by data rows
+    if not values:
+        return pd.DataFrame()
+    # The API trims trailing empty cells, so pad each row back out to the full width
+    values = [row + [""] * (SHEET_COLUMN_COUNT - len(row)) for row in values]
+    df = pd.DataFrame(values[1:], columns=values[0])
+    df = df.loc[:, df.columns != ""] # Drop the padded lock column on sheets without a 'Locked By' header
+    df = df.set_index("Referral ID") # Hash index for O(1) lookups; row order still matches the sheet
+    if version is not None:
+        write_cached_data(df, version, generation)
+    return df
+
+@st.cache_data(ttl=60, show_spinner="Loading referrals...")
 def load_data():
     try:
-        spreadsheet = gc.open(GOOGLE_SHEET_NAME)
-        worksheet = spreadsheet.worksheet(WORKSHEET_NAME)
-        data = worksheet.get_all_records() # Get all data as a list of dictionaries
-        df = pd.DataFrame(data)
+        state = get_data_cache_state()
+        for _ in range(LOAD_ATTEMPTS):
+            generation = state["generation"] # Read before fetching; see invalidate_data_cache
+            df = fetch_data(generation)
+            if state["generation"] == generation:
+                break # No write landed while loading, so this frame isn't older than any of our writes
+            # A write landed mid-load: this frame may predate it, and st.cache_data would keep it for 60s
+        df.attrs["load_token"] = uuid.uuid4().hex # Identifies this load for split_and_sort's cache
         return df
     except gspread.exceptions.SpreadsheetNotFound:
         st.error(f"Google Sheet '{GOOGLE_SHEET_NAME}' not found. Please check the name and sharing permissions.")
@@ -46,55 +172,261 @@ def load_data():
         st.error(f"Error loading data from Google Sheet: {e}")
         st.stop()
 
-def append_data(row_data):
+def get_row_index(referral_id):
+    # Look the Referral ID up in the already-loaded data instead of fetching column A again
+    df = load_data()
+    if referral_id not in df.index:
+        return None
+    position = df.index.get_loc(referral_id)
+    if not isinstance(position, int): # Duplicate IDs give a slice/mask; use the first match
+        position = pd.RangeIndex(len(df))[position][0]
+    return position + 2 # +2 because gspread is 1-indexed and the header is row 1
+
+def append_data(rows, retried_rows=()):
+    # Appends a batch of rows in one API call; RAW skips server-side parsing of the values
+    # Runs on the write executor, so errors are raised for report_pending_writes() instead of shown here
+    if retried_rows:
+        # A failed append may still have landed, so only re-send rows whose Referral ID isn't in column A yet
+        saved_ids = set(get_worksheet().col_values(1))
+        rows = [row for row in retried_rows if row[0] not in saved_ids] + list(rows)
+    if not rows:
+        return
+    get_worksheet().append_rows(rows, value_input_option="RAW", insert_data_option="INSERT_ROWS")
+    # Invalidate only the sheet data cache so the dashboard updates immediately after new data is added
+    invalidate_data_cache()
+
+# --- Background Writes (Sheets calls run off the script thread so the UI isn't blocked) ---
+@st.cache_resource
+def get_executor():
+    return ThreadPoolExecutor(max_workers=4)
+
+def submit_write(description, success_message, write_fn, *args):
+    future = get_executor().submit(write_fn, *args)
+    st.session_state.setdefault("pending_writes", []).append({
+        "description": description,
+        "success_message": success_message,
+        "future": future,
+        "write_fn": write_fn,
+        "args": args,
+    })
+    return future
+
+def submit_referrals(description, success_message, rows):
+    # Referrals that failed to save earlier go out in the same append_rows call, unless they turn out to be saved already
+    retried_rows = st.session_state.pop("pending_submits", [])
+    return submit_write(description, success_message, append_data, rows, retried_rows)
+
+def collect_finished_writes():
+    # Move finished writes into "write_results" so their outcome stays on screen until the user's next action
+    still_pending = []
+    results = st.session_state.setdefault("write_results", [])
+    for write in st.session_state.get("pending_writes", []):
+        future = write["future"]
+        if not future.done():
+            still_pending.append(write)
+        elif future.exception() is not None:
+            results.append(("error", f"❌ {write['description']} could not be saved: {future.exception()}. Please try again or contact support if the issue persists."))
+            if write["write_fn"] is append_data:
+                # Keep the rows (older retries first) so they go out with the next batch instead of being lost
+                rows, retried_rows = write["args"]
+                st.session_state.setdefault("pending_submits", []).extend(list(retried_rows) + rows)
+        else:
+            results.append(("success", write["success_message"]))
+            if write["write_fn"] is append_data:
+                st.balloons() # Visual confirmation
+    st.session_state["pending_writes"] = still_pending
+
+def report_pending_writes():
+    # Confirm or report writes once they have actually finished; nothing is shown as saved before that
+    collect_finished_writes()
+    for kind, message in st.session_state["write_results"]:
+        if kind == "success":
+            st.success(message)
+        else:
+            st.error(message)
+    pending = st.session_state["pending_writes"]
+    if pending:
+        st.info(f"⏳ {len(pending)} referral(s) queued, saving to Google Sheets... Please keep this page open until it is confirmed.")
+    offer_unsent_retry()
+
+def show_write_status():
+    # A full rerun means the user has acted since the last report, so earlier outcomes have been seen
+    st.session_state["write_results"] = []
+    # While saves are running, re-run just this fragment on a timer so their outcome appears without a click
+    run_every = WRITE_POLL_INTERVAL if st.session_state.get("pending_writes") else None
+    st.fragment(run_every=run_every)(report_pending_writes)()
+
+def offer_unsent_retry():
+    unsent = st.session_state.get("pending_submits", [])
+    if unsent:
+        st.warning(f"⚠️ {len(unsent)} referral(s) have not been saved yet. They will be re-sent with your next referral.")
+        if st.button("🔁 Retry Unsent Referrals Now"):
+            submit_referrals("Unsent referrals", "✅ Unsent referrals saved successfully!", [])
+            st.rerun()
+
+def batch_update_by_referral_id(referral_id, updates, headers):
+    # Writes several {column_name: new_value} pairs for one referral in a single API call.
+    # headers must be freshly read (see read_referral_row) so columns staff have moved land in the right place.
     try:
-        spreadsheet = gc.open(GOOGLE_SHEET_NAME)
-        worksheet = spreadsheet.worksheet(WORKSHEET_NAME)
-        worksheet.append_row(row_data)
-        # Invalidate cache so the dashboard updates immediately after new data is added
-        st.cache_data.clear()
-        return True
+        return _batch_update(get_worksheet(), referral_id, updates, headers)
     except Exception as e:
-        st.error(f"Error appending data: {e}")
+        st.error(f"Error updating data: {e}")
         return False
 
-def update_cell_by_referral_id(referral_id, column_name, new_value):
-    try:
-        spreadsheet = gc.open(GOOGLE_SHEET_NAME)
-        worksheet = spreadsheet.worksheet(WORKSHEET_NAME)
-        
-        # Find the row index for the given Referral ID
-        # gspread uses 1-based indexing for rows/columns; header is row 1
-        # We search in 'Referral ID' column (which is assumed to be the first column)
-        referral_ids = worksheet.col_values(1) # Column 1 is 'Referral ID'
-        if referral_id not in referral_ids:
-            st.error(f"Referral ID '{referral_id}' not found in the sheet. This might indicate a data sync issue or an invalid ID.")
-            return False
-        
-        row_index = referral_ids.index(referral_id) + 1 # +1 because gspread is 1-indexed (headers are row 1)
+def _batch_update(worksheet, referral_id, updates, headers):
+    row_index = get_row_index(referral_id)
+    if row_index is None:
+        st.error(f"Referral ID '{referral_id}' not found in the sheet. This might indicate a data sync issue or an invalid ID.")
+        return False
 
-        # Find the column index for the given column_name
-        headers = worksheet.row_values(1) # Get the header row
+    col_indexes = []
+    for column_name in updates:
         if column_name not in headers:
             st.error(f"Column '{column_name}' not found in sheet headers. Please check your Google Sheet headers.")
             return False
-        
-        col_index = headers.index(column_name) + 1 # +1 because gspread is 1-indexed
+        col_indexes.append(headers.index(column_name) + 1) # +1 because gspread is 1-indexed
+
+    first_col, last_col = col_indexes[0], col_indexes[-1]
+    if col_indexes == list(range(first_col, last_col + 1)):
+        # Adjacent columns in sheet order (e.g. the acknowledgement fields, J:M): write them as one row range
+        worksheet.update(
+            range_name=f"{gspread.utils.rowcol_to_a1(row_index, first_col)}:{gspread.utils.rowcol_to_a1(row_index, last_col)}",
+            values=[list(updates.values())],
+            value_input_option="USER_ENTERED", # Parse values as if typed into the sheet
+        )
+    else:
+        cell_updates = [
+            {"range": gspread.utils.rowcol_to_a1(row_index, col_index), "values": [[new_value]]}
+            for col_index, new_value in zip(col_indexes, updates.values())
+        ]
+        worksheet.batch_update(cell_updates, value_input_option="USER_ENTERED") # Parse values as if typed into the sheet
+    # Invalidate only the sheet data cache so the dashboard updates immediately after data is updated
+    invalidate_data_cache()
+    return True
+
+# --- Acknowledgement Locks (best-effort: Sheets has no compare-and-set, so this is read-then-write) ---
+def get_lock_nonce():
+    return st.session_state.setdefault("lock_nonce", uuid.uuid4().hex)
 
-        worksheet.update_cell(row_index, col_index, new_value)
-        # Invalidate cache so the dashboard updates immediately after data is updated
-        st.cache_data.clear()
-        return True
+def read_referral_row(worksheet, referral_id, row_index=None):
+    # One read of the header row and the referral's row together. The row number comes from data that may be
+    # up to a minute old, so the row is None if it no longer holds this Referral ID (the sheet was sorted or a
+    # row deleted). The headers are live, so column positions are never older than this read either.
+    # Returns (row_index, headers, row as {header: value}). Pass row_index to skip the lookup in load_data.
+    if row_index is None:
+        row_index = get_row_index(referral_id)
+    if row_index is None:
+        return None, [], None
+    header_range, row_range = worksheet.batch_get(["1:1", f"{row_index}:{row_index}"])
+    headers = header_range[0] if header_range else []
+    row = dict(zip(headers, row_range[0] if row_range else []))
+    if row.get("Referral ID") != referral_id:
+        invalidate_data_cache() # Reload so the next lookup sees the sheet's current order
+        return row_index, headers, None
+    return row_index, headers, row
+
+def parse_lock_holder(value):
+    # Lock cells hold "<session nonce>@<unix time>"; empty or expired locks have no holder
+    holder, _, locked_at = (value or "").partition("@")
+    if not holder or not locked_at.isdigit() or time.time() - int(locked_at) > LOCK_TIMEOUT_SECONDS:
+        return None
+    return holder
+
+ROW_MOVED_MESSAGE = "🔄 The Google Sheet has changed since it was loaded (rows may have been sorted or deleted). The referrals have been reloaded; please select the referral again."
+
+def _acquire_lock(worksheet, referral_id):
+    # Returns None once the lock is held (or locking isn't set up), otherwise the reason it couldn't be taken
+    row_index, headers, row = read_referral_row(worksheet, referral_id)
+    if row is None:
+        return ROW_MOVED_MESSAGE
+    if LOCK_COLUMN not in headers:
+        return None # Locking isn't set up on this sheet
+    if parse_lock_holder(row.get(LOCK_COLUMN)) not in (None, get_lock_nonce()):
+        return "🔒 Another staff member is acknowledging this referral right now. Please try again in a few minutes."
+    cell = gspread.utils.rowcol_to_a1(row_index, headers.index(LOCK_COLUMN) + 1)
+    worksheet.update(range_name=cell, values=[[f"{get_lock_nonce()}@{int(time.time())}"]], value_input_option="RAW")
+    return None
+
+def release_held_lock():
+    # Clears this session's lock cell (if it is still ours) when the selection moves away from that referral
+    referral_id = st.session_state.pop("held_lock", None)
+    held_row = st.session_state.pop("held_lock_row", None)
+    if referral_id is None or held_row is None:
+        return
+    def release(worksheet):
+        # Uses the row remembered when the lock was taken, so releasing never needs load_data (e.g. from the PHC view)
+        row_index, headers, row = read_referral_row(worksheet, referral_id, held_row)
+        if row is None or LOCK_COLUMN not in headers or parse_lock_holder(row.get(LOCK_COLUMN)) != get_lock_nonce():
+            return # Gone, moved, or already taken over by someone else: leave it alone
+        cell = gspread.utils.rowcol_to_a1(row_index, headers.index(LOCK_COLUMN) + 1)
+        worksheet.update(range_name=cell, values=[[""]], value_input_option="RAW")
+    try:
+        release(get_worksheet())
+    except Exception:
+        pass # The lock still expires by itself after LOCK_TIMEOUT_SECONDS
+
+def claim_referral(referral_id):
+    # Takes the lock once per selection, so widget reruns don't hit the sheet again
+    if st.session_state.get("held_lock") == referral_id:
+        return None
+    release_held_lock() # Switching to another referral frees the previous one
+    try:
+        reason = _acquire_lock(get_worksheet(), referral_id)
     except Exception as e:
-        st.error(f"Error updating data: {e}")
-        return False
+        return f"Error locking referral: {e}"
+    if reason is None:
+        st.session_state["held_lock"] = referral_id
+        st.session_state["held_lock_row"] = get_row_index(referral_id) # Already loaded: _acquire_lock just used it
+    return reason
 
-# --- Streamlit App Layout ---
-st.set_page_config(layout="wide", page_title="Hospital Referral System 🏥")
+def check_before_acknowledging(referral_id):
+    # Re-read the row just before writing: it must still hold this referral, and our lock must not have
+    # expired and been taken by someone else. Returns (reason, headers); reason is None if it's safe to write,
+    # and headers are the live header row to write against.
+    def check(worksheet):
+        _, headers, row = read_referral_row(worksheet, referral_id)
+        if row is None:
+            return ROW_MOVED_MESSAGE, headers
+        if LOCK_COLUMN in headers and parse_lock_holder(row.get(LOCK_COLUMN)) != get_lock_nonce():
+            return "🔒 Your lock on this referral expired and another staff member has taken it. Please reselect it to check its status.", headers
+        return None, headers
+    try:
+        return check(get_worksheet())
+    except Exception as e:
+        return f"Error checking referral: {e}", []
+
+@lru_cache(maxsize=1)
+def format_timestamp(second):
+    return datetime.fromtimestamp(second).strftime("%Y-%m-%d %H:%M:%S")
 
+def now_str():
+    # Reruns within the same second reuse the already formatted string
+    return format_timestamp(int(time.time()))
+
+def as_datetime(column):
+    # Sort key: compare timestamps as datetime64 rather than as strings.
+    # format="mixed" parses each value on its own, so staff-typed times like "2024-01-04 9:05" or a bare date
+    # still sort by date instead of all matching the first value's format. Only text that isn't a date at all
+    # (or is empty) becomes NaT, and NaT sorts last.
+    return pd.to_datetime(column, errors="coerce", format="mixed", cache=True)
+
+# cache_resource hands back the same frames instead of unpickling copies; nothing below mutates them
+@st.cache_resource(max_entries=4)
+def split_and_sort(load_token, _df):
+    # Keyed on the load token alone; the leading underscore tells Streamlit not to hash the DataFrame
+    _df = _df.drop(columns=[LOCK_COLUMN], errors="ignore") # Lock nonces aren't useful to staff
+    acknowledged_status = _df["Gbagada Acknowledged"].values
+    unacknowledged_df = _df[acknowledged_status == "No"].sort_values(by="Date/Time of Referral", ascending=False, key=as_datetime)
+    acknowledged_df = _df[acknowledged_status == "Yes"].sort_values(by="Date/Time of Presentation", ascending=False, key=as_datetime)
+    pending_options = ("Select a Referral", *unacknowledged_df.index) # Built once per load for the selectbox
+    return unacknowledged_df, acknowledged_df, pending_options
+
+# --- Streamlit App Layout ---
 st.title("🏥 PHC - Gbagada General Hospital Referral System")
 st.markdown("---")
 
+show_write_status()
+
 # --- User Role Selection in Sidebar (for non-authenticated version) ---
 # This will be replaced by authentication logic if you re-introduce streamlit-authenticator
 user_role = st.sidebar.radio(
@@ -104,6 +436,7 @@ user_role = st.sidebar.radio(
 )
 
 if user_role == "Primary Health Care (PHC)":
+    release_held_lock() # Switching role frees any referral this session was acknowledging
     st.header("📤 Refer a New Patient to Gbagada General Hospital")
     st.markdown("Please fill out the form below to refer a patient.")
 
@@ -121,7 +454,7 @@ if user_role == "Primary Health Care (PHC)":
             diagnosis = st.text_area("Diagnosis / Reason for Referral:", height=150, help="Briefly describe the patient's diagnosis or the reason for referral to Gbagada General Hospital.")
             
             # Current time for referral (auto-generated and displayed)
-            referral_datetime = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            referral_datetime = now_str()
             st.info(f"📅 **Referral Time (Auto-generated):** {referral_datetime}")
 
         st.markdown("---")
@@ -133,7 +466,7 @@ if user_role == "Primary Health Care (PHC)":
                 st.error("❗ Please fill in all **required fields** (Patient Name, Date of Birth, Gender, Referring PHC, Diagnosis, Referring Doctor).")
             else:
                 # Generate a unique ID for the referral
-                referral_id = str(uuid.uuid4()) 
+                referral_id = uuid.uuid4().hex # 32 hex chars, no dashes
                 
                 # Data must be in the same order as your Google Sheet headers
                 row_data = [
@@ -149,18 +482,18 @@ if user_role == "Primary Health Care (PHC)":
                     "No", # Gbagada Acknowledged (default to No)
                     "",   # Date/Time of Presentation (initially empty)
                     "",   # Acknowledged By (initially empty)
-                    ""    # Gbagada Notes (initially empty)
+                    "",   # Gbagada Notes (initially empty)
+                    ""    # Locked By (initially empty)
                 ]
                 
-                # Attempt to append data and provide immediate feedback
-                with st.spinner("Submitting referral..."): # Show a spinner while submitting
-                    if append_data(row_data):
-                        st.success(f"✅ Referral for **{patient_name}** from **{referring_phc}** submitted successfully!")
-                        st.info(f"Your Referral ID is: **{referral_id}**. Please note this for future reference.")
-                        st.balloons() # Visual confirmation
-                        # No need for st.rerun() here as clear_on_submit=True handles form clearing
-                    else:
-                        st.error("❌ Failed to submit referral. Please try again or contact support if the issue persists.")
+                # Append in the background; success (with the Referral ID) is only shown once the save has finished
+                submit_referrals(
+                    f"Referral for {patient_name} ({referral_id})",
+                    f"✅ Referral for **{patient_name}** from **{referring_phc}** submitted successfully! "
+                    f"Your Referral ID is: **{referral_id}**. Please note this for future reference.",
+                    [row_data],
+                )
+                st.rerun() # Rerun so the status area starts polling for this save's outcome
                         
 elif user_role == "Gbagada General Hospital":
     st.header("📥 Incoming Patient Referrals (Gbagada General Hospital)")
@@ -171,17 +504,15 @@ elif user_role == "Gbagada General Hospital":
     if data_df.empty:
         st.info("ℹ️ No referrals found yet.")
     else:
-        # Separate acknowledged from unacknowledged
-        unacknowledged_df = data_df[data_df["Gbagada Acknowledged"] == "No"].copy()
-        acknowledged_df = data_df[data_df["Gbagada Acknowledged"] == "Yes"].copy()
+        # Separate acknowledged from unacknowledged; recomputed only when the data is reloaded
+        unacknowledged_df, acknowledged_df, pending_options = split_and_sort(data_df.attrs["load_token"], data_df)
 
         st.subheader("❗ Pending Referrals")
         if unacknowledged_df.empty:
             st.success("🎉 All referrals have been acknowledged! No pending actions.")
         else:
             st.dataframe(
-                unacknowledged_df.sort_values(by="Date/Time of Referral", ascending=False)
-                                 .set_index("Referral ID"), 
+                unacknowledged_df,
                 use_container_width=True,
                 height=300 # Set a fixed height for better scroll experience if many entries
             )
@@ -191,13 +522,16 @@ elif user_role == "Gbagada General Hospital":
             
             referral_to_ack = st.selectbox(
                 "Select Referral ID to Acknowledge:",
-                options=["Select a Referral"] + unacknowledged_df["Referral ID"].tolist(),
+                options=pending_options,
                 help="Choose the unique ID of the patient who has presented at Gbagada General Hospital."
             )
 
-            if referral_to_ack != "Select a Referral":
+            claim_problem = claim_referral(referral_to_ack) if referral_to_ack != "Select a Referral" else None
+            if claim_problem:
+                st.warning(claim_problem)
+            elif referral_to_ack != "Select a Referral":
                 # Display details of the selected referral for confirmation
-                selected_referral_details = unacknowledged_df[unacknowledged_df["Referral ID"] == referral_to_ack].iloc[0]
+                selected_referral_details = unacknowledged_df.loc[[referral_to_ack]].iloc[0]
                 
                 st.write(f"---")
                 st.write(f"**Patient Name:** {selected_referral_details['Patient Name']}")
@@ -208,7 +542,7 @@ elif user_role == "Gbagada General Hospital":
                 with st.form("acknowledge_form"):
                     time_of_presentation = st.text_input(
                         "Time of Presentation (YYYY-MM-DD HH:MM:SS):", 
-                        value=datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                        value=now_str(),
                         help="Enter the exact date and time the patient presented at Gbagada Hospital. Auto-filled with current time."
                     )
                     acknowledged_by = st.text_input(
@@ -226,19 +560,32 @@ elif user_role == "Gbagada General Hospital":
                         if not all([time_of_presentation, acknowledged_by]):
                             st.warning("Please fill in **Time of Presentation** and **Acknowledged By** fields.")
                         else:
-                            # Update the relevant cells in the Google Sheet
-                            with st.spinner("Updating referral status..."):
-                                success1 = update_cell_by_referral_id(referral_to_ack, "Gbagada Acknowledged", "Yes")
-                                success2 = update_cell_by_referral_id(referral_to_ack, "Date/Time of Presentation", time_of_presentation)
-                                success3 = update_cell_by_referral_id(referral_to_ack, "Acknowledged By", acknowledged_by)
-                                success4 = update_cell_by_referral_id(referral_to_ack, "Gbagada Notes", gbagada_notes)
-
-                                if success1 and success2 and success3 and success4:
-                                    st.success(f"✅ Referral for **{selected_referral_details['Patient Name']}** acknowledged successfully!")
-                                    st.rerun() # Refresh the page to update the dashboard immediately
-                                else:
-                                    st.error("❌ Failed to acknowledge referral. Please check logs.")
+                            ack_problem, live_headers = check_before_acknowledging(referral_to_ack)
+                            if ack_problem:
+                                release_held_lock() # Clears our nonce if the cell is still ours; otherwise leaves it
+                                st.error(ack_problem)
+                            else:
+                                ack_updates = {
+                                    "Gbagada Acknowledged": "Yes",
+                                    "Date/Time of Presentation": time_of_presentation,
+                                    "Acknowledged By": acknowledged_by,
+                                    "Gbagada Notes": gbagada_notes,
+                                }
+                                if LOCK_COLUMN in live_headers:
+                                    ack_updates[LOCK_COLUMN] = "" # Release the lock in the same write
+                                # Update the relevant cells in the Google Sheet
+                                with st.spinner("Updating referral status..."):
+                                    success = batch_update_by_referral_id(referral_to_ack, ack_updates, live_headers)
+
+                                    if success:
+                                        st.session_state.pop("held_lock", None) # The write above cleared the lock cell
+                                        st.session_state.pop("held_lock_row", None)
+                                        st.success(f"✅ Referral for **{selected_referral_details['Patient Name']}** acknowledged successfully!")
+                                        st.rerun() # Refresh the page to update the dashboard immediately
+                                    else:
+                                        st.error("❌ Failed to acknowledge referral. Please check logs.")
             else:
+                release_held_lock() # Deselecting frees any referral this session was acknowledging
                 st.info("Select a pending referral from the dropdown above to acknowledge its arrival.")
 
 
@@ -248,8 +595,7 @@ elif user_role == "Gbagada General Hospital":
             st.info("No referrals have been acknowledged yet.")
         else:
             st.dataframe(
-                acknowledged_df.sort_values(by="Date/Time of Presentation", ascending=False)
-                               .set_index("Referral ID"), 
+                acknowledged_df,
                 use_container_width=True,
                 height=300 # Set a fixed height
             )
\ No newline at end of file